@@ -1,90 +1,221 @@
 #!/usr/bin/env python3
 
+import http.client
 import logging
-import multiprocessing
-import pathlib
-import time
-from typing import Set, Callable
+import os
+import shutil
+import socket
+import subprocess
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set, Callable, Collection, Dict, Iterable, Sequence
 
 import click
-import sh
-from sh import podman
-from sh import systemctl
 
 SERVICES_BASE_PATH = "/docker/services/"
+SYSTEMCTL_SHOW_CHUNK_SIZE = 16
+PARALLEL_PROCESSES = 8
+PODMAN_SOCKET_PATH = "/run/podman/podman.sock"
+PODMAN_API_VERSION = "v3.0.0"
+# absolute paths let subprocess spawn the commands with posix_spawn
+SYSTEMCTL = shutil.which("systemctl") or "systemctl"
+PODMAN = shutil.which("podman") or "podman"
 
 
-def resolve_image_units():
-    services_path = pathlib.Path(SERVICES_BASE_PATH)
-    services_set = set(map(lambda p: str(p.name), services_path.iterdir()))
+class PodmanConnection(http.client.HTTPConnection):
+    """HTTP connection to the podman REST API listening on a unix socket."""
+
+    def __init__(self, socket_path: str):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def run(argv: Sequence[str], err_to_out: bool = False) -> bytes:
+    """Run a command to completion and return its output.
+
+    Raises :class:`subprocess.CalledProcessError` on a non-zero exit code.
+    """
+    process = subprocess.run(
+        argv,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if err_to_out else None,
+        close_fds=False,
+    )
+    process.check_returncode()
+    return process.stdout
+
+
+def run_captured(argv: Sequence[str]) -> subprocess.CompletedProcess:
+    """Run a command to completion, capturing stdout and stderr together."""
+    return subprocess.run(
+        argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=False
+    )
+
+
+def run_parallel(
+    argvs: Iterable[Sequence[str]], done: Callable[[subprocess.CompletedProcess], None]
+):
+    """Run commands in worker threads, at most ``PARALLEL_PROCESSES`` at a time.
+
+    ``done`` is called with every completed process.
+    """
+    with ThreadPoolExecutor(max_workers=PARALLEL_PROCESSES) as pool:
+        for process in pool.map(run_captured, argvs):
+            done(process)
+
+
+def systemctl_show(units: Iterable[str], properties: Iterable[str]) -> Dict[str, Dict[str, str]]:
+    """Query properties of many units with batched ``systemctl show`` calls.
+
+    The units are split into chunks which are queried in parallel.
+    Returns a mapping from unit id to its requested properties.
+    """
+    units = list(units)
+    properties = {"Id", *properties}
+    show_argv = [SYSTEMCTL, "show", f"--property={','.join(properties)}"]
+    chunks = [
+        units[i : i + SYSTEMCTL_SHOW_CHUNK_SIZE]
+        for i in range(0, len(units), SYSTEMCTL_SHOW_CHUNK_SIZE)
+    ]
+
+    unit_properties: Dict[str, Dict[str, str]] = {}
+    with ThreadPoolExecutor(max_workers=PARALLEL_PROCESSES) as pool:
+        for show in pool.map(lambda chunk: run([*show_argv, *chunk]), chunks):
+            output = show.decode(encoding="utf-8", errors="replace")
+            # systemctl separates the records of multiple units with an empty line
+            for record in output.strip().split("\n\n"):
+                record_properties: Dict[str, str] = {}
+                for line in record.splitlines():
+                    key, _, value = line.partition("=")
+                    if key in properties:
+                        record_properties[key] = value
+                unit_properties[record_properties["Id"]] = record_properties
+    return unit_properties
+
+
+def pod_unit(service: str) -> str:
+    return f"pod@{service}.service"
+
+
+def resolve_image_units() -> Dict[str, Dict[str, str]]:
+    with os.scandir(SERVICES_BASE_PATH) as entries:
+        # only directories with a pod definition can be launched by pod@.service
+        services_set = {
+            entry.name
+            for entry in entries
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, f"pod-{entry.name}.yaml"))
+        }
 
     logging.info(f"Found {len(services_set)} services: {str(services_set)}")
 
-    systemctl("daemon-reload")
+    run([SYSTEMCTL, "daemon-reload"])
 
-    def remove_masked_unit(
+    def remove_masked_units(
         _item_set: Set[str],
-        item: str,
         item_to_unit: Callable[[str], str] = lambda i: i,
-    ):
-        load_state = systemctl.show(
-            "--property=LoadState", "--value", item_to_unit(item)
-        )
-        load_state = load_state.stdout.strip().decode(
-            encoding="utf-8", errors="replace"
-        )
-        logging.debug(f"{item} load state: {repr(load_state)}")
-        if load_state == "masked":
-            logging.info(f"Removed masked entry: {item}")
-            _item_set.remove(item)
-
-    with click.progressbar(list(services_set), label="Checking service units..", show_pos=True) as bar:
-        for service in bar:
-            remove_masked_unit(services_set, service, lambda srv: f"pod@{srv}.service")
-
-    def add_wants_to_image_units(_image_units: Set[str], unit: str):
-        wants = systemctl.show("--property=Wants", "--value", unit)
-        wants_list = (
-            wants.stdout.strip().decode(encoding="utf-8", errors="replace").split(" ")
-        )
-        logging.debug(f"{unit} wants: {repr(wants_list)}")
-        for next_unit in wants_list:
-            if next_unit.startswith("image@") and next_unit.endswith(".service"):
-                logging.info(f"Found {unit} wants {next_unit}")
-                _image_units.add(next_unit)
+        extra_properties: Iterable[str] = (),
+    ) -> Dict[str, Dict[str, str]]:
+        units = {item_to_unit(item): item for item in _item_set}
+        unit_properties = systemctl_show(units.keys(), ["LoadState", *extra_properties])
+        for unit, properties in list(unit_properties.items()):
+            load_state = properties["LoadState"]
+            logging.debug(f"{unit} load state: {repr(load_state)}")
+            if load_state == "masked":
+                logging.info(f"Removed masked entry: {units[unit]}")
+                _item_set.remove(units[unit])
+                del unit_properties[unit]
+        return unit_properties
+
+    with click.progressbar(length=len(services_set), label="Checking service units..", show_pos=True) as bar:
+        remove_masked_units(services_set, pod_unit)
+        bar.update(len(services_set))
 
     image_units: Set[str] = set()
 
     with click.progressbar(
-        length=len(services_set) * 2, label="Collecting container image services.."
+        length=len(services_set), label="Collecting container image services.."
     ) as bar:
-        for service in services_set:
-            add_wants_to_image_units(image_units, f"pod@{service}.service")
-            bar.update(1)
-
-        new_image_units: Set[str] = set(image_units)
-        bar.length = len(image_units) * 2
-
-        while len(new_image_units) > 0:
-            units_to_check = list(new_image_units)
-            new_image_units = set()  # reset new image units
-            for image_unit in units_to_check:
-                add_wants_to_image_units(new_image_units, image_unit)
-                bar.update(1)
-
-            bar.length += len(new_image_units)
-            image_units.update(
-                new_image_units
-            )  # add new image units to all image units
+        if len(services_set) > 0:
+            # systemd walks the dependency graph of all pods at once,
+            # without arguments it would list the dependencies of default.target
+            dependencies = run(
+                [SYSTEMCTL, "list-dependencies", "--plain", "--all", "--no-pager", *map(pod_unit, services_set)]
+            )
+            for line in dependencies.decode(encoding="utf-8", errors="replace").splitlines():
+                unit = line.strip()
+                # images shared by several pods are listed once per pod
+                if unit.startswith("image@") and unit.endswith(".service") and unit not in image_units:
+                    logging.info(f"Found image unit {unit}")
+                    image_units.add(unit)
+        bar.update(len(services_set))
 
     with click.progressbar(
-        list(image_units), label="Checking container image units..", show_pos=True
+        length=len(image_units), label="Checking container image units..", show_pos=True
     ) as bar:
-        for image_unit in bar:
-            remove_masked_unit(image_units, image_unit)
+        # fetch the environment along with the load state to save another round of queries
+        image_unit_properties = remove_masked_units(image_units, extra_properties=["Environment"])
+        bar.update(len(image_units))
 
     logging.info(f"Found {len(image_units)} images: {str(image_units)}")
-    return image_units
+    return image_unit_properties
+
+
+def untag_images(image_tags: Set[str], done: Callable[[], None]):
+    """Remove the given tags from their images, ignoring missing ones.
+
+    Uses the podman REST API if its socket is available and falls back to
+    running ``podman untag`` otherwise. ``done`` is called for every tag.
+    """
+    remaining_tags = set(image_tags)
+    if os.path.exists(PODMAN_SOCKET_PATH):
+        connection = PodmanConnection(PODMAN_SOCKET_PATH)
+        try:
+            for image_tag in image_tags:
+                path = urllib.parse.quote(f"/{PODMAN_API_VERSION}/libpod/images/{image_tag}/untag")
+                connection.request("POST", path)
+                response = connection.getresponse()
+                body = response.read()
+                remaining_tags.remove(image_tag)
+                done()
+                # ignore missing image tags
+                if response.status >= 300 and response.status != 404:
+                    raise RuntimeError(
+                        f"Untagging {image_tag} failed with status {response.status}: {body}"
+                    )
+        except OSError as error:
+            # e.g. a stale socket file left behind by a stopped podman.socket
+            logging.warning(f"podman API not usable, falling back to podman untag: {error}")
+        finally:
+            connection.close()
+
+    def untag_done(process: subprocess.CompletedProcess):
+        done()
+        # ignore missing image tags
+        if process.returncode != 0 and "image not known".encode() not in process.stdout:
+            raise subprocess.CalledProcessError(process.returncode, process.args, process.stdout)
+
+    run_parallel(map(lambda tag: [PODMAN, "untag", tag], remaining_tags), untag_done)
+
+
+def reset_failed(units: Collection[str]):
+    """Reset the failed state of all units with a single ``systemctl reset-failed`` call."""
+    if len(units) == 0:
+        # without arguments systemctl would reset all failed units
+        return
+
+    try:
+        run([SYSTEMCTL, "reset-failed", *units], err_to_out=True)
+    except subprocess.CalledProcessError as error:
+        # systemctl continues with the remaining units and reports each failure on its own line
+        for line in error.output.decode(encoding="utf-8", errors="replace").splitlines():
+            if line.endswith(" not loaded."):
+                logging.info(f"Not resetting failed state, {line}")
+            else:
+                raise
 
 
 @click.command()
@@ -99,76 +230,30 @@ def main(verbose):
     image_units = resolve_image_units()
     image_tags: Set[str] = set()
 
-    with click.progressbar(image_units, label="Collecting container image tags..") as bar:
-        for image_unit in bar:
-            environment = systemctl.show(
-                "--property=Environment",
-                "--value",
-                image_unit,
-            )
-            environment_list = (
-                environment.stdout.strip()
-                .decode(encoding="utf-8", errors="replace")
-                .split(" ")
-            )
-            logging.debug(f"{image_unit} environment: {repr(environment_list)}")
-            for envvar in environment_list:
-                search_str = "IMAGE_TAG="
-                if envvar.startswith(search_str):
-                    image_tags.add(envvar[len(search_str) :])
+    for image_unit, properties in image_units.items():
+        environment_list = properties.get("Environment", "").split(" ")
+        logging.debug(f"{image_unit} environment: {repr(environment_list)}")
+        for envvar in environment_list:
+            key, _, value = envvar.partition("=")
+            if key == "IMAGE_TAG":
+                image_tags.add(value)
 
-    started_processes = []
     with click.progressbar(
         length=len(image_tags), label="Untagging container images..", show_pos=True
     ) as bar:
-        for image_tag in image_tags:
-            process = podman.untag(
-                image_tag,
-                _bg=True,
-                _err_to_out=True,
-                _done=lambda cmd, success, exit_code: bar.update(1),
-            )
-            started_processes.append(process)
-            time.sleep(0.02)
-        # join processes
-        for p in started_processes:
-            try:
-                p.wait()
-            except sh.ErrorReturnCode as error:
-                # ignore missing image tags
-                if "image not known".encode() in p.stdout:
-                    pass
-                else:
-                    raise
+        untag_images(image_tags, lambda: bar.update(1))
 
-    started_processes = []
     with click.progressbar(
         length=len(image_units), label="Building images..", show_pos=True
     ) as bar:
-        semaphore = multiprocessing.Semaphore(8)
-        for image_unit in image_units:
-            try:
-                systemctl("reset-failed", image_unit, _bg=False, _err_to_out=True)
-            except sh.ErrorReturnCode as error:
-                if f"Unit {image_unit} not loaded".encode() in error.stdout:
-                    logging.info(
-                        f"Not resetting failed state for {image_unit}, unit not loaded"
-                    )
-                else:
-                    raise
 
-            semaphore.acquire()
-
-            def restart_done(cmd, success, exit_code):
-                bar.update(1)
-                if not success:
-                    logging.warning(f"{cmd.cmd}{tuple(cmd.call_args)} completed with exit code {exit_code}")
-                semaphore.release()
+        def restart_done(process: subprocess.CompletedProcess):
+            bar.update(1)
+            if process.returncode != 0:
+                logging.warning(f"{' '.join(process.args)} completed with exit code {process.returncode}")
 
-            process = systemctl.restart(image_unit, _bg=True, _done=restart_done)
-            started_processes.append(process)
-        # join processes
-        [p.wait() for p in started_processes]
+        reset_failed(image_units)
+        run_parallel(map(lambda unit: [SYSTEMCTL, "restart", "--no-ask-password", unit], image_units), restart_done)
 
 
 if __name__ == "__main__":
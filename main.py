@@ -1,23 +1,84 @@
+import asyncio
+import http.client
 import json
 import logging
 import os
-import pathlib
+import shutil
+import socket
+import subprocess
 import sys
-import threading
+import time
 import traceback
-from datetime import datetime, timedelta
-from queue import SimpleQueue
-from signal import signal, SIGHUP, SIGINT, SIGTERM, setitimer, SIGALRM, ITIMER_REAL, SIGUSR1, SIGUSR2, strsignal
-
-import click
-import sh
-from sh import podman
+import urllib.parse
+from datetime import datetime
+from signal import SIGHUP, SIGINT, SIGKILL, SIGTERM, SIGUSR1, SIGUSR2, strsignal
+from typing import List, Optional, Tuple
 
 SERVICES_BASE_PATH = "/docker/services/"
+PODMAN_SOCKET_PATH = "/run/podman/podman.sock"
+PODMAN_API_VERSION = "v3.0.0"
+NOTIFY_SOCKET = os.environ.get("NOTIFY_SOCKET")
+PODMAN = shutil.which("podman") or "podman"
+HANDLED_SIGNALS = (SIGINT, SIGTERM, SIGHUP, SIGUSR1, SIGUSR2)
+# pending work is kept as a bit mask of signal numbers, bit 0 is not a signal and requests a pod check
+SIGNAL_BITS = {signum: 1 << signum for signum in HANDLED_SIGNALS}
+PENDING_CHECK = 1
+PODMAN_ERRORS = (subprocess.CalledProcessError, http.client.HTTPException)
+# event subscriptions ending sooner count as failed, after a few of those the pod is polled instead
+EVENTS_MIN_UPTIME = 10
+EVENTS_MAX_FAILURES = 3
+CHECK_INTERVAL = 10
+
+
+def event_time(event: dict) -> float:
+    """Returns the UNIX time of a podman event, or the current time for events without one."""
+    if "timeNano" in event:
+        return event["timeNano"] / 1e9
+    if "time" in event:
+        return event["time"]
+    return time.time()
+
+
+class PodmanConnection(http.client.HTTPConnection):
+    """HTTP connection to the podman REST API listening on a unix socket."""
+
+    def __init__(self, socket_path: str):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+async def execute(*argv: str, stdout=None, check: bool = True) -> subprocess.CompletedProcess:
+    """Run a command without blocking the event loop.
+
+    Output is passed through unless ``stdout`` says otherwise.
+    Raises :class:`subprocess.CalledProcessError` on a non-zero exit code if ``check`` is set.
+    """
+    # an absolute executable path and close_fds=False let subprocess use posix_spawn
+    process = await asyncio.create_subprocess_exec(*argv, stdin=subprocess.DEVNULL, stdout=stdout, close_fds=False)
+    output, _ = await process.communicate()
+    completed = subprocess.CompletedProcess(argv, process.returncode, output)
+    if check:
+        completed.check_returncode()
+    return completed
+
 
-# noinspection PyCallingNonCallable
-shlog = sh(_out=sys.stdout, _err=sys.stderr)
-sdnotify = sh.Command("systemd-notify")
+async def podman(*args: str, stdout=None, check: bool = True) -> subprocess.CompletedProcess:
+    return await execute(PODMAN, *args, stdout=stdout, check=check)
+
+
+def sdnotify(*assignments: str):
+    """Send state changes to the service manager, like sd_notify(3)."""
+    if NOTIFY_SOCKET is None:
+        return
+
+    # a leading @ denotes a socket in the abstract namespace
+    address = f"\0{NOTIFY_SOCKET[1:]}" if NOTIFY_SOCKET.startswith("@") else NOTIFY_SOCKET
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+        notify_socket.sendto("\n".join(assignments).encode(), address)
 
 
 class PodKeeper:
@@ -28,158 +89,325 @@ class PodKeeper:
         self.podnet_args += ("--log-level", log_level) if log_level else ()
         self.replace = replace
         self.remove = remove
-        identifier_path = pathlib.PurePath(identifier)
-        if len(identifier_path.parts) != 1:
-            raise ValueError(f"identifier has path parts: {identifier_path}")
-        self.podhome = pathlib.Path(SERVICES_BASE_PATH) / identifier_path
-        if not self.podhome.exists():
+        if "/" in identifier or identifier in ("", ".", ".."):
+            raise ValueError(f"identifier has path parts: {identifier}")
+        self.podhome = os.path.join(SERVICES_BASE_PATH, identifier)
+        if not os.path.isdir(self.podhome):
             raise NotADirectoryError(f"pod home does not exist: {self.podhome}")
         self.podname = f"{identifier}_pod"
         self.podyaml = f"pod-{identifier}.yaml"
-        podyaml_complete = (self.podhome / self.podyaml)
-        if not podyaml_complete.exists():
+        self.inspect_argv = (
+            PODMAN, "pod", "inspect", "--format", "{{range .Containers}}{{.Name}}={{.State}}\n{{end}}", self.podname
+        )
+        self.kill_argv = (PODMAN, "pod", "kill", "--signal")
+        # talk to the podman service directly if it is available, the CLI is the fallback
+        self.api = PodmanConnection(PODMAN_SOCKET_PATH) if os.path.exists(PODMAN_SOCKET_PATH) else None
+        podyaml_complete = os.path.join(self.podhome, self.podyaml)
+        if not os.path.isfile(podyaml_complete):
             raise FileNotFoundError(f"pod definition does not exist: {podyaml_complete}")
-        self.stopping = threading.Event()
-        self.reloading = threading.Event()
-        self.checking = threading.Event()
-        self.waiter = threading.Event()
-        self.last_check = datetime.utcnow()
-        self.passing_signal = threading.Event()
-        self.pass_signal_nums = SimpleQueue()
-
-    def destroy(self, signum, stackframe):
-        print("Destroy signal", signum, file=sys.stderr, flush=True)
-        self.stopping.set()
-        self.waiter.set()
+        self.stopping = False
+        self.waiter = asyncio.Event()
+        self.last_check = time.time()
+        self.pending = 0
+        # earliest time a requested check looks for container logs from, the last check if unset
+        self.check_since = None
+        self.started = time.monotonic()
 
-    def reload(self, signum, stackframe):
-        print("Reload signal", signum, file=sys.stderr, flush=True)
-        self.reloading.set()
+    def wake(self, signum):
+        # runs on the event loop, which receives signals through signal.set_wakeup_fd
+        self.pending |= SIGNAL_BITS[signum]
         self.waiter.set()
 
-    def check(self, signum, stackframe):
-        self.checking.set()
+    def request_check(self, since: Optional[float] = None):
+        if since is not None:
+            self.check_since = since if self.check_since is None else min(self.check_since, since)
+        self.pending |= PENDING_CHECK
         self.waiter.set()
 
-    def passthrough(self, signum, stackframe):
-        self.pass_signal_nums.put(item=signum, block=True, timeout=3)
-        self.passing_signal.set()
+    async def run(self):
+        os.chdir(self.podhome)
+        if self.replace and await self.pod_exists():
+            print(f"Replacing existing pod {self.podname}", file=sys.stderr)
+            await self.pod_stop()
+            await self.pod_rm(force=True)
+
+        print(f"Starting pod {self.podname} at {datetime.utcfromtimestamp(self.last_check)}", file=sys.stderr)
+        self.started = time.monotonic()
+        await podman("play", "kube", self.podyaml, *self.podnet_args)
+        watcher = asyncio.create_task(self.watch_events())
+        watcher.add_done_callback(self.watcher_done)
+        try:
+            sdnotify("READY=1", f"MAINPID={os.getpid()}", "STATUS=Monitoring pod...")
+
+            waiter_wait = self.waiter.wait
+            waiter_clear = self.waiter.clear
+            signal_bits = tuple(SIGNAL_BITS.items())
+
+            while not self.stopping:
+                await waiter_wait()
+                waiter_clear()
+
+                pending, self.pending = self.pending, 0
+
+                for signum, signal_bit in signal_bits:
+                    if pending & signal_bit:
+                        await self.handle_signal(signum)
+
+                if pending & PENDING_CHECK:
+                    await self.check_pod()
+
+            sdnotify("STATUS=Stopping pod")
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            await self.stop_pod()
+
+    def watcher_done(self, watcher: asyncio.Task):
+        # dead containers go unnoticed without the event watcher, it only ends by cancellation
+        if watcher.cancelled():
+            return
+        error = watcher.exception()
+        print("Event watcher failed, stopping pod", file=sys.stderr)
+        if error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+        self.stopping = True
         self.waiter.set()
 
-    def run(self):
-        os.chdir(self.podhome)
-        if self.replace and podman.pod.exists(self.podname, _ok_code=[0, 1]).exit_code == 0:
-            print(f"Replacing existing pod {self.podname}", file=sys.stderr, flush=True)
-            shlog.podman.pod.stop(self.podname)
-            shlog.podman.pod.rm("-f", self.podname)
+    async def watch_events(self):
+        # check the pod only when one of its containers died
+        container_prefix = f"{self.podname}-"
+        encoded_container_prefix = container_prefix.encode()
+        failures = 0
+        while failures < EVENTS_MAX_FAILURES:
+            subscribed = time.monotonic()
+            # replay events since the pod was started, so none are lost before or between subscriptions
+            since = f"{int(time.monotonic() - self.started) + 1}s"
+            process = await asyncio.create_subprocess_exec(
+                PODMAN, "events", "--since", since, "--filter", "event=died", "--format", "json",
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, close_fds=False
+            )
+            try:
+                while True:
+                    try:
+                        line = await process.stdout.readline()
+                    except ValueError as error:
+                        # the stream reader drops lines over its limit, one of them may have been our event
+                        print(f"Skipping overlong event, checking pod: {error}", file=sys.stderr)
+                        self.request_check(time.time())
+                        continue
+                    if len(line) == 0:
+                        break
+                    # events of other pods' containers are skipped without decoding them
+                    if encoded_container_prefix not in line:
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        print(f"Undecodable event, checking pod: {line!r}", file=sys.stderr)
+                        self.request_check(time.time())
+                        continue
+                    if event.get("Name", "").startswith(container_prefix):
+                        self.request_check(event_time(event))
+            except BaseException:
+                # only a cancelled or failed watcher leaves the child running, at EOF it exits on its own
+                if process.returncode is None:
+                    process.terminate()
+                await process.wait()
+                raise
+            await process.wait()
+
+            print(f"Event stream ended with exit code {process.returncode}", file=sys.stderr)
+            failures = failures + 1 if time.monotonic() - subscribed < EVENTS_MIN_UPTIME else 0
+            if failures < EVENTS_MAX_FAILURES:
+                await asyncio.sleep(1)
+
+        print(f"Event stream unusable, checking pod every {CHECK_INTERVAL}s", file=sys.stderr)
+        while True:
+            self.request_check()
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    async def pod_api(self, method: str, action: str, **params) -> Optional[Tuple[int, bytes]]:
+        """Request an action on this pod from the podman REST API in a worker thread.
+
+        Returns ``None`` if the API cannot be reached, callers then fall back to the CLI for good.
+        Raises :class:`http.client.HTTPException` on error responses other than 304 and 404.
+        """
+        path = f"/{PODMAN_API_VERSION}/libpod/pods/{urllib.parse.quote(self.podname)}"
+        if len(action) > 0:
+            path += f"/{action}"
+        if len(params) > 0:
+            path += f"?{urllib.parse.urlencode(params)}"
+
+        def request():
+            try:
+                self.api.request(method, path)
+                response = self.api.getresponse()
+            except (ConnectionError, http.client.RemoteDisconnected):
+                # the socket activated service exits when idle, reconnect once
+                self.api.close()
+                self.api.request(method, path)
+                response = self.api.getresponse()
+            body = response.read()
+            # 304 reports that the pod already is in the requested state
+            if response.status >= 300 and response.status not in (304, 404):
+                raise http.client.HTTPException(f"{method} {path} failed with status {response.status}: {body}")
+            return response.status, body
 
-        print(f"Starting pod {self.podname} at {self.last_check}", file=sys.stderr, flush=True)
-        shlog.podman.play.kube(self.podyaml, *self.podnet_args)
         try:
-            shlogger = logging.getLogger("sh.command")
-            oldlevel = shlogger.level
-            shlogger.setLevel(logging.ERROR)
+            return await asyncio.get_running_loop().run_in_executor(None, request)
+        except OSError as error:
+            # e.g. a stale socket file left behind by a stopped podman.socket
+            print(f"podman API not usable, falling back to the podman CLI: {error}", file=sys.stderr)
+            self.api.close()
+            self.api = None
+            return None
 
-            if 'NOTIFY_SOCKET' in os.environ:
-                sdnotify("--ready", f"--pid={os.getpid()}", "--status=Monitoring pod...")
+    async def pod_exists(self) -> bool:
+        if self.api is not None:
+            response = await self.pod_api("GET", "exists")
+            if response is not None:
+                status, _ = response
+                return status == 204
+        return (await podman("pod", "exists", self.podname, check=False)).returncode == 0
 
-            while not self.stopping.is_set():
-                self.waiter.wait()
-                self.waiter.clear()
+    async def pod_containers(self) -> List[Tuple[str, str]]:
+        """Returns name and state of all containers in the pod."""
+        if self.api is not None:
+            response = await self.pod_api("GET", "json")
+            if response is not None:
+                status, body = response
+                if status == 404:
+                    raise http.client.HTTPException(f"pod {self.podname} does not exist")
+                pod_description = json.loads(body)
+                return [(container["Name"], container["State"]) for container in pod_description["Containers"]]
 
-                if self.passing_signal.is_set():
-                    self.passing_signal.clear()
-                    while not self.pass_signal_nums.empty():
-                        signum = self.pass_signal_nums.get(block=True, timeout=2)
-                        self.signal_pod(signum)
+        inspect_command = await execute(*self.inspect_argv, stdout=subprocess.PIPE)
+        containers = []
+        for container in inspect_command.stdout.decode(encoding="utf-8", errors="replace").splitlines():
+            container_name, _, container_state = container.partition("=")
+            containers.append((container_name, container_state))
+        return containers
 
-                if self.checking.is_set():
-                    self.checking.clear()
-                    self.check_pod()
+    async def pod_kill(self, signum):
+        if self.api is not None:
+            response = await self.pod_api("POST", "kill", signal=signum)
+            if response is not None:
+                status, _ = response
+                if status == 404:
+                    raise http.client.HTTPException(f"pod {self.podname} does not exist")
+                return
+        await execute(*self.kill_argv, str(signum), self.podname)
 
-                if self.reloading.is_set():
-                    self.reloading.clear()
-                    self.signal_pod(SIGHUP)
+    async def pod_stop(self, timeout=None):
+        if self.api is not None:
+            response = await self.pod_api("POST", "stop", **({} if timeout is None else {"t": timeout}))
+            if response is not None:
+                status, _ = response
+                if status == 404:
+                    raise http.client.HTTPException(f"pod {self.podname} does not exist")
+                return
+        timeout_args = () if timeout is None else ("-t", str(timeout))
+        await podman("pod", "stop", *timeout_args, self.podname)
 
-            if 'NOTIFY_SOCKET' in os.environ:
-                sdnotify("--status=Stopping pod")
+    async def pod_rm(self, force=False):
+        if self.api is not None:
+            response = await self.pod_api("DELETE", "", **({"force": "true"} if force else {}))
+            if response is not None:
+                status, _ = response
+                if status == 404:
+                    raise http.client.HTTPException(f"pod {self.podname} does not exist")
+                return
+        await podman("pod", "rm", *(("-f",) if force else ()), self.podname)
 
-            logging.getLogger("sh.command").setLevel(oldlevel)
-        finally:
-            self.stop_pod()
+    async def handle_signal(self, signum):
+        if signum in (SIGINT, SIGTERM):
+            print("Destroy signal", signum, file=sys.stderr)
+            self.stopping = True
+        elif signum == SIGHUP:
+            print("Reload signal", signum, file=sys.stderr)
+            await self.signal_pod(SIGHUP)
+        else:
+            await self.signal_pod(signum)
 
-    def signal_pod(self, signum):
-        print(f"Sending signal '{strsignal(signum)}' to pod {self.podname}", file=sys.stderr, flush=True)
+    async def signal_pod(self, signum):
+        print(f"Sending signal '{strsignal(signum)}' to pod {self.podname}", file=sys.stderr)
         try:
-            shlog.podman.pod.kill("--signal", str(signum), self.podname)
-        except sh.ErrorReturnCode:
-            print("Error signaling pod", file=sys.stderr, flush=True)
+            await self.pod_kill(signum)
+        except PODMAN_ERRORS:
+            print("Error signaling pod", file=sys.stderr)
             traceback.print_exc()
 
-    def check_pod(self):
-        new_timestamp = datetime.utcnow()
-        inspect_command = podman.pod.inspect(self.podname)
-        pod_description = json.loads(inspect_command.stdout)
-        for container in pod_description["Containers"]:
-            if container["State"] != "running":
-                print(f"Container {container['Name']} exited", file=sys.stderr, flush=True)
-                logs_since = self.last_check - timedelta(seconds=10)
-                print(f"Log since last check (-10s):\n", file=sys.stderr, flush=True)
-                shlog.podman.logs('--since', logs_since.isoformat(), container['Name'], _out=sys.stderr)
-                self.stopping.set()
+    async def check_pod(self):
+        new_timestamp = time.time()
+        since, self.check_since = self.check_since, None
+        logs_since = datetime.utcfromtimestamp((self.last_check if since is None else since) - 10)
+        for container_name, container_state in await self.pod_containers():
+            if container_state != "running":
+                print(f"Container {container_name} exited", file=sys.stderr)
+                print(f"Log since {logs_since.isoformat()}:\n", file=sys.stderr)
+                await podman("logs", "--since", logs_since.isoformat(), container_name, stdout=sys.stderr)
+                self.stopping = True
         self.last_check = new_timestamp
 
-    def stop_pod(self):
-        print("Stopping pod", self.podname, file=sys.stderr, flush=True)
-        try:
-            shlog.podman.pod.stop("-t", "19", self.podname)
-            successful_stopped = True
-        except sh.ErrorReturnCode:
-            print(f"First stop of {self.podname} was not successful!", file=sys.stderr, flush=True)
-            successful_stopped = False
+    async def stop_pod(self):
+        print("Stopping pod", self.podname, file=sys.stderr)
         try:
-            shlog.podman.pod.stop("-t", "5", self.podname)
-        except sh.ErrorReturnCode:
-            if not successful_stopped:
-                print(f"Second stop of {self.podname} was not successful!", file=sys.stderr, flush=True)
+            await self.pod_stop(timeout=19)
+        except PODMAN_ERRORS:
+            print(f"Stop of {self.podname} was not successful, killing it!", file=sys.stderr)
+            try:
+                await self.pod_kill(SIGKILL)
+            except PODMAN_ERRORS:
+                print(f"Kill of {self.podname} was not successful!", file=sys.stderr)
 
         if self.remove:
             try:
-                shlog.podman.pod.rm(self.podname)
-            except sh.ErrorReturnCode:
-                print(f"Removal of {self.podname} was not successful!", file=sys.stderr, flush=True)
-
-
-@click.command()
-@click.option("--network", default="brodge", help="Network for the created pod")
-@click.option("--log-driver", default="journald", help="Logging driver for the created pod")
-@click.option("--log-level", default="", help="Controls log-level on podman call")
-@click.option("--replace/--no-replace", default=True, help="Controls replacement of previously running pod with the "
-                                                           "same name")
-@click.option("--remove/--keep", default=True, help="Controls removal of pod after stopping")
-@click.argument("identifier")
+                await self.pod_rm(force=True)
+            except PODMAN_ERRORS:
+                print(f"Removal of {self.podname} was not successful!", file=sys.stderr)
+
+        if self.api is not None:
+            self.api.close()
+
+
 def main(network, log_driver, log_level, replace, remove, identifier):
     logging.basicConfig(level=logging.INFO)
+    # stderr is only line-buffered on its own since Python 3.9, diagnostics must not wait for a flush
+    sys.stderr.reconfigure(line_buffering=True)
 
-    keeper = PodKeeper(
-        network=network,
-        log_driver=log_driver,
-        log_level=log_level,
-        replace=replace,
-        remove=remove,
-        identifier=identifier
-    )
-
-    signal(SIGINT, keeper.destroy)
-    signal(SIGTERM, keeper.destroy)
-    signal(SIGHUP, keeper.reload)
-    signal(SIGALRM, keeper.check)
-    signal(SIGUSR1, keeper.passthrough)
-    signal(SIGUSR2, keeper.passthrough)
-    setitimer(ITIMER_REAL, 4.0, 10.0)
+    # the loop has to be current before the keeper is built, asyncio.Event binds to it on Python < 3.10
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        keeper = PodKeeper(
+            network=network,
+            log_driver=log_driver,
+            log_level=log_level,
+            replace=replace,
+            remove=remove,
+            identifier=identifier
+        )
+        for signum in HANDLED_SIGNALS:
+            loop.add_signal_handler(signum, keeper.wake, signum)
 
-    keeper.run()
+        loop.run_until_complete(keeper.run())
+    finally:
+        loop.close()
 
 
 if __name__ == '__main__':
-    main()
+    # click is only needed when running as a script, importing this module stays cheap
+    import click
+
+    @click.command()
+    @click.option("--network", default="brodge", help="Network for the created pod")
+    @click.option("--log-driver", default="journald", help="Logging driver for the created pod")
+    @click.option("--log-level", default="", help="Controls log-level on podman call")
+    @click.option("--replace/--no-replace", default=True, help="Controls replacement of previously running pod with "
+                                                               "the same name")
+    @click.option("--remove/--keep", default=True, help="Controls removal of pod after stopping")
+    @click.argument("identifier")
+    def cli(**kwargs):
+        main(**kwargs)
+
+    cli()